@@ -10,26 +10,38 @@ _status_messages = {
 }
 
 
-def conjgrad(b, Adot, dot, maxiter=None, tol=1e-10, rtol=1e-1, verbose=0):
+def _safe_div(num, den):
+    # num / den where den is nonzero, and 0 elsewhere
+    return torch.where(den != 0, num / den, torch.zeros_like(num))
+
+
+def conjgrad(b, Adot, dot, maxiter=None, tol=1e-10, rtol=1e-1, verbose=0,
+             x0=None, M_inv=None):
     verbose = int(verbose)
     if maxiter is None:
         maxiter = 20 * (b.numel() if b.dim() == 1 else b[0].numel())
+    float_eps = torch.finfo(b.dtype).eps
+
     b_abs = b.abs().sum()
     termcond = rtol * b_abs * b_abs.sqrt().clamp(0, 0.5)
-    float_eps = torch.finfo(b.dtype).eps
 
-    # initialize x
-    x = torch.zeros_like(b)
+    # initialize x (optionally warm-started)
+    if x0 is None:
+        x = torch.zeros_like(b)
+        r = -b
+    else:
+        x = x0
+        r = Adot(x0) - b
 
     def terminate(warnflag):
         if verbose:
             print(_status_messages[warnflag])
         return x
 
-    # iterate
-    r = -b
-    p = b
-    rs_old = dot(r, r)
+    # iterate (optionally with preconditioner M_inv ~ A^{-1})
+    z = r if M_inv is None else M_inv(r)
+    p = -z
+    rs_old = dot(r, z)
     for i in range(maxiter):
         if r.abs().sum() <= termcond:
             return terminate(1)
@@ -41,18 +53,22 @@ def conjgrad(b, Adot, dot, maxiter=None, tol=1e-10, rtol=1e-1, verbose=0):
         elif curv_sum < 0:
             if i == 0:
                 # fall back to steepest descent direction
-                x = - rs_old / curv * b
+                x = x - _safe_div(rs_old, curv) * p
             return terminate(3)
-        alpha = rs_old / curv
+        # batch entries whose residual is already zero have rs_old = curv = 0;
+        # they take zero steps rather than 0/0
+        alpha = _safe_div(rs_old, curv)
         x = x + alpha * p
         r = r + alpha * Ap
-        rs_new = dot(r, r)
-        if rs_new.sum().sqrt() < tol:
+        z = r if M_inv is None else M_inv(r)
+        rs_new = dot(r, z)
+        rnorm = (rs_new if M_inv is None else dot(r, r)).sum().sqrt()
+        if rnorm < tol:
             return terminate(0)
-        p = - r + (rs_new / rs_old) * p
+        p = - z + _safe_div(rs_new, rs_old) * p
         rs_old = rs_new
         if verbose > 1:
-            print('iter: %i - rs: %0.4f' % (i, rs_new.sum().sqrt()))
+            print('iter: %i - rs: %0.4f' % (i, rnorm))
 
     return terminate(4)
 
@@ -1,6 +1,6 @@
 from .ista import ista
 from .gpsr import gpsr_basic
-from .iterative_ridge import iterative_ridge
+from .iterative_ridge import iterative_ridge, clear_gram_cache
 from .interior_point import interior_point
 from .coordinate_descent import coord_descent, coord_descent_mod
 from .split_bregman import split_bregman
@@ -1,16 +1,148 @@
 import warnings
+import weakref
+from collections import OrderedDict
 from torch import Tensor
 import torch
-from scipy.optimize import minimize_scalar
 from scipy.optimize.optimize import _status_message
 
 from ...conjgrad import conjgrad
-from ..utils import batch_cholesky_solve
+from ..utils import (batch_cholesky_solve, batch_cholesky_soa,
+                     batch_cholesky_solve_soa, safe_inv_abs)
+
+# largest batch size for which small Cholesky solves are moved to the CPU
+_CPU_MAX_BATCH = 2048
+
+# systems this small (and batches this large) are factored in
+# structure-of-arrays layout, with the batch as the fastest-moving dimension
+_SOA_MAX_DIM = 16
+_SOA_MIN_BATCH = 2048
+
+
+# Small LRU cache of Gram matrices W^T W, keyed by the identity of W.
+# Entries hold only a weak reference to W, are dropped when W is freed, and
+# are validated against its in-place version counter, so in-place updates to
+# the dictionary (e.g. by `update_dict` during dictionary learning)
+# invalidate them automatically. Writes through `weight.data` bypass the
+# version counter; call `clear_gram_cache()` after modifying a dictionary
+# that way.
+_gram_cache = OrderedDict()
+_GRAM_CACHE_SIZE = 4
+
+
+def clear_gram_cache():
+    """Clear the Gram matrices cached by `iterative_ridge`"""
+    _gram_cache.clear()
+
+
+def _drop_gram(key, ref):
+    # weakref callback: remove the entry of a freed dictionary, unless it has
+    # already been replaced
+    entry = _gram_cache.get(key)
+    if entry is not None and entry[0] is ref:
+        del _gram_cache[key]
+
+
+def _gram(weight):
+    # NOTE: the returned [D,D] tensor may be shared with the cache and with
+    # other calls; it must not be modified in place.
+    if weight.requires_grad and torch.is_grad_enabled():
+        # never share autograd graphs across calls
+        return torch.mm(weight.T, weight)
+    key = id(weight)
+    entry = _gram_cache.get(key)
+    if entry is not None:
+        ref, version, A = entry
+        if ref() is weight and version == weight._version:
+            _gram_cache.move_to_end(key)
+            return A
+    A = torch.mm(weight.T, weight)
+    ref = weakref.ref(weight, lambda ref: _drop_gram(key, ref))
+    _gram_cache[key] = (ref, weight._version, A)
+    _gram_cache.move_to_end(key)
+    while len(_gram_cache) > _GRAM_CACHE_SIZE:
+        _gram_cache.popitem(last=False)
+    return A
+
+
+def _cholesky_solve(b, L, soa=False, out=None):
+    # the factor may be in lower precision than b (mixed precision mode), in
+    # which case the solve runs in the precision of L and is cast back
+    if not soa and L.dtype == b.dtype:
+        if out is not None:
+            out = out.unsqueeze(2)
+        return torch.cholesky_solve(b.unsqueeze(2), L, out=out).squeeze(2)
+    if soa:
+        x = batch_cholesky_solve_soa(b.T.to(L.dtype), L).T
+    else:
+        x = torch.cholesky_solve(b.unsqueeze(2).to(L.dtype), L).squeeze(2)
+    return x.to(b.dtype) if out is None else out.copy_(x)
+
+
+def exact_line_search(z, p, resid, Wp, alpha, t_max=10.):
+    """Exact line search for the Lasso objective along direction p
+
+    Finds, for each batch entry, the step t in [0, t_max] minimizing
+
+        0.5 * ||resid + t * Wp||^2 + alpha * ||z + t * p||_1
+
+    where resid = z @ W.T - x and Wp = p @ W.T. The objective is a convex
+    piecewise quadratic in t with breakpoints t_i = -z_i / p_i, so the
+    minimizer is found by sorting the breakpoints and locating the interval
+    on which the derivative changes sign. No function evaluations needed.
+
+    Parameters
+    ----------
+    z : Tensor of shape [batch, code_size]
+        Current code vectors
+    p : Tensor of shape [batch, code_size]
+        Search direction
+    resid : Tensor of shape [batch, inp_size]
+        Reconstruction residual at z
+    Wp : Tensor of shape [batch, inp_size]
+        Search direction mapped through the dictionary
+    alpha : float
+        Sparsity weight of the Lasso problem
+    t_max : float
+        Upper bound on the step size
+
+    Returns
+    -------
+    t : Tensor of shape [batch, 1]
+        Optimal step sizes
+
+    """
+    # derivative of the quadratic term is a + c * t
+    a = torch.sum(resid * Wp, 1, keepdim=True)  # [B,1]
+    c = Wp.pow(2).sum(1, keepdim=True).clamp_(min=torch.finfo(z.dtype).tiny)
+
+    # slope of the L1 term just after t=0
+    sign0 = torch.where(z == 0, p.sign(), z.sign())
+    s0 = alpha * torch.sum(sign0 * p, 1, keepdim=True)  # [B,1]
+
+    # each coefficient that crosses zero increases the slope by 2*alpha*|p_i|
+    crosses = z * p < 0
+    bkpts = torch.where(crosses, -z / p, torch.full_like(z, float('inf')))
+    bkpts, order = bkpts.sort(1)
+    incr = (2 * alpha * p.abs()).masked_fill_(~crosses, 0).gather(1, order)
+    slope = torch.cat([s0, s0 + incr.cumsum(1)], 1)  # [B,D+1]
+    left = torch.cat([torch.zeros_like(s0), bkpts], 1)  # [B,D+1]
+    right = torch.cat([bkpts, torch.full_like(s0, float('inf'))], 1)  # [B,D+1]
+
+    # the derivative is nondecreasing; count the intervals on which it is
+    # still negative at the right endpoint to find the one with the minimum
+    dright = a + c * right + slope
+    j = torch.sum(dright < 0, 1, keepdim=True)  # [B,1]
+    t = -(a + slope.gather(1, j)) / c
+    t = torch.maximum(t, left.gather(1, j))
+    t = torch.minimum(t, right.gather(1, j))
+
+    return t.clamp_(0, t_max)
 
 
 def iterative_ridge(z0, x, weight, alpha=1.0, tol=1e-5, tikhonov=1e-4, eps=None,
                     maxiter=10, line_search=True, cg=False, cg_options=None,
-                    verbose=False):
+                    refactor_tol=0., refactor_every=10, cpu_threshold=64,
+                    precision='full', cuda_graph=False, verbose=False):
     """Iterated Ridge Regression method for Lasso problems
 
     Explained in section 2.5 of Mark Schmidt, 2005:
@@ -23,7 +155,10 @@ def iterative_ridge(z0, x, weight, alpha=1.0, tol=1e-5, tikhonov=1e-4, eps=None,
     x : Tensor of shape [batch, inp_size]
         Reconstruction target
     weight : Tensor of shape [inp_size, code_size]
-        Dictionary matrix (i.e. decoder weights)
+        Dictionary matrix (i.e. decoder weights). The Gram matrix W^T W is
+        cached across calls (unless it requires grad) and recomputed after
+        in-place updates to `weight`. Writes through `weight.data` are not
+        detected; call `clear_gram_cache()` after modifying it that way.
     alpha : float
         Sparsity weight of the Lasso problem
     tol : float
@@ -40,7 +175,34 @@ def iterative_ridge(z0, x, weight, alpha=1.0, tol=1e-5, tikhonov=1e-4, eps=None,
         Whether to use conjugate gradient to solve the ridge problem at each
         iteration. When `False` (default), Cholesky factorization is used.
     cg_options : dict, optional
-        Options to pass to conjugate gradient solver. Ignored if `cg=False`
+        Options to pass to conjugate gradient solver. The relative tolerance
+        defaults to `rtol=1e-2`. Ignored if `cg=False`
+    refactor_tol : float
+        Maximum relative change in the diagonal of the ridge system for which
+        the cached Cholesky factor is reused (with one step of iterative
+        refinement) instead of refactorizing. The default of 0 refactorizes
+        at every iteration. Ignored if `cg=True`
+    refactor_every : int
+        Maximum number of iterations that a cached Cholesky factor may be
+        reused before a full refactorization. Ignored if `refactor_tol=0`
+    cpu_threshold : int
+        For CUDA inputs with code_size <= cpu_threshold (and a modest batch
+        size), the Cholesky solves are performed on the CPU, where small
+        batched factorizations are much faster. Set to 0 to disable.
+        Ignored if `cg=True`
+    precision : str
+        Either 'full' (default) or 'mixed'. With 'mixed', float64 ridge
+        systems are factored in float32 and each solve is corrected with one
+        step of float64 iterative refinement. Ignored for float32 inputs and
+        if `cg=True`
+    cuda_graph : bool
+        For CUDA inputs, capture one full iteration (factorization, solve,
+        line search and update) in a CUDA graph after a warm-up iteration and
+        replay it thereafter, which removes the per-kernel launch overhead
+        that dominates small problems. Requires the Cholesky solver,
+        `refactor_tol=0` and `precision='full'` (a warning is issued and the
+        option ignored otherwise). When used, the solves stay on the GPU
+        regardless of `cpu_threshold`.
     verbose : bool
         Verbosity indicator
 
@@ -53,8 +215,14 @@ def iterative_ridge(z0, x, weight, alpha=1.0, tol=1e-5, tikhonov=1e-4, eps=None,
     if tikhonov < 1e-5:
         warnings.warn('small regularization value %0.4e may lead to '
                       'inprecise results.' % tikhonov)
-    if cg and cg_options is None:
-        cg_options = {}
+    if cg:
+        # the inner solves are warm-started but stop relative to the norm of
+        # the right hand side, so they need a tighter tolerance than the
+        # conjgrad default to make progress near the solution
+        cg_options = {'rtol': 1e-2, **(cg_options or {})}
+    if precision not in ('full', 'mixed'):
+        raise ValueError("precision must be either 'full' or 'mixed'.")
+    mixed = precision == 'mixed' and weight.dtype == torch.float64
     if eps is None:
         eps = torch.finfo(weight.dtype).eps
     tol = z0.numel() * tol
@@ -73,61 +241,225 @@ def iterative_ridge(z0, x, weight, alpha=1.0, tol=1e-5, tikhonov=1e-4, eps=None,
     # right hand side of the residual sum of squares (RSS) problem. [B,D]
     rhs = torch.mm(x, weight)  # [B,D] = [B,K] @ [K,D]
 
-    # batch gram matrix W^T @ W. [D,D]
-    A = torch.mm(weight.T, weight)
+    # batch gram matrix W^T @ W (cached across calls; not modified). [D,D]
+    A = _gram(weight)
+
+    # per-iteration work buffers for the diagonal factor
+    is_zero = torch.empty(z.shape, dtype=torch.bool, device=z.device)
+    diag = torch.empty_like(z)
+    rhs_k = torch.empty_like(rhs)
+
+    # The Cholesky iteration can be made free of host syncs, in which case it
+    # is captured once as a CUDA graph and replayed (see below)
+    use_graph = (cuda_graph and z.is_cuda and not cg and not mixed
+                 and refactor_tol <= 0)
+    if cuda_graph and not use_graph:
+        warnings.warn("cuda_graph=True is ignored; it requires CUDA inputs, "
+                      "cg=False, refactor_tol=0 and precision='full'.")
 
     if not cg:
-        A = A.expand(z.size(0), -1, -1)  # [B,D,D]
+        # The [B,D,D] ridge system is allocated once. Between iterations only
+        # its diagonal changes, plus the rows/columns of newly-zeroed
+        # coefficients (the zero set can only grow), so we patch it in place.
+        # Small systems are kept on the CPU, where batched Cholesky avoids the
+        # per-call launch and workspace overhead of the GPU routines (unless
+        # the iteration is captured as a CUDA graph, which removes that
+        # overhead).
+        solve_device = z.device
+        if (z.is_cuda and not use_graph and z.size(1) <= cpu_threshold
+                and z.size(0) <= _CPU_MAX_BATCH):
+            solve_device = torch.device('cpu')
+        A_diag = A.diagonal().to(solve_device) + tikhonov  # [D]
+        soa = (not use_graph and z.size(1) <= _SOA_MAX_DIM
+               and z.size(0) >= _SOA_MIN_BATCH)
+        if soa:
+            # A_k is a [B,D,D] view of [D,D,B] storage
+            A_soa = A.to(solve_device).unsqueeze(2).expand(-1, -1, z.size(0))
+            A_soa = A_soa.clone(memory_format=torch.contiguous_format)
+            A_k = A_soa.permute(2, 0, 1)
+        else:
+            # always a copy: for batch size 1 `.contiguous()` would return a
+            # view of the cached Gram matrix, which is patched in place below
+            A_k = A.to(solve_device).expand(z.size(0), -1, -1)
+            A_k = A_k.clone(memory_format=torch.contiguous_format)
+        is_zero_prev = torch.zeros(z.shape, dtype=torch.bool,
+                                   device=solve_device)
+        L = None
+        z_buf = A_k.new_empty(z.shape)  # solution buffer, reused each iteration
 
-    for k in range(1, maxiter + 1):
-        # compute diagonal factor
-        zmag = z.abs()
-        is_zero = zmag < eps
-        diag = (alpha / zmag).masked_fill(is_zero, 0)
-        rhs_k = rhs.masked_fill(is_zero, 0.)
-
-        # solve ridge sub-problem
-        if cg:
-            # use conjugate gradient method
-            def Adot(v):
-                Av = torch.mm(v.masked_fill(is_zero, 0.), A)
-                Av.masked_fill_(is_zero, 0.)
-                Av.addcmul_(diag + tikhonov, v)
-                return Av
-            dot = lambda u, v: torch.sum(u*v, 1, keepdim=True)
-            z_sol = conjgrad(rhs_k, Adot, dot, **cg_options)
+    def diag_factor(z):
+        # compute diagonal factor and the masked right hand side
+        safe_inv_abs(z, eps, out=diag)
+        torch.eq(diag, 0, out=is_zero)
+        diag.mul_(alpha)
+        rhs_k.copy_(rhs).masked_fill_(is_zero, 0.)
+
+    def patch_system(is_zero_s, diag_s, incremental=True):
+        # Mask the rows/columns of zeroed coefficients in A_k and rewrite its
+        # diagonal. Incremental masking only touches newly-zeroed coefficients
+        # but needs a host sync to find out whether there are any; otherwise
+        # the whole zero set is re-masked (masking is idempotent).
+        if incremental:
+            new_zero = is_zero_s & ~is_zero_prev
+            changed = bool(new_zero.any())
         else:
-            # use cholesky factorization
-            A_k = A.masked_fill((is_zero.unsqueeze(1) | is_zero.unsqueeze(2)), 0.)
-            A_k.diagonal(dim1=1, dim2=2).add_(diag + tikhonov)
-            z_sol = batch_cholesky_solve(rhs_k, A_k)  # [B,D]
+            new_zero, changed = is_zero_s, True
+        if changed:
+            A_k.masked_fill_(new_zero.unsqueeze(1) | new_zero.unsqueeze(2), 0.)
+        is_zero_prev.copy_(is_zero_s)
+        A_k_diag = A_k.diagonal(dim1=1, dim2=2)
+        A_k_diag.copy_(A_diag.expand_as(diag_s))
+        A_k_diag.add_(diag_s).masked_fill_(is_zero_s, tikhonov)
+        return A_k_diag, changed
 
+    def factor():
+        # batched cholesky factor of A_k. Failures are reported through info
+        if soa:
+            return batch_cholesky_soa(A_soa.float() if mixed else A_soa)
+        return torch.linalg.cholesky_ex(A_k.float() if mixed else A_k,
+                                        check_errors=False)
+
+    def take_step(z, z_sol):
+        # move from z towards the ridge solution z_sol
         if line_search:
-            # line search optimization
-            p = z_sol - z
-            line_obj = lambda t: float(f(z.add(p, alpha=t)))
-            res = minimize_scalar(line_obj, bounds=(0,10), method='bounded')
-            t = res.x
-            fval = torch.tensor(res.fun)
-            update = p.mul(t)
-            z = torch.where(is_zero, z, z + update)
+            # exact line search. The objective is separable across the batch,
+            # so each sample gets its own step size.
+            p = (z_sol - z).masked_fill_(is_zero, 0.)
+            resid = torch.mm(z, weight.T) - x  # [B,K]
+            Wp = torch.mm(p, weight.T)  # [B,K]
+            t = exact_line_search(z, p, resid, Wp, alpha, t_max=10.)  # [B,1]
+            update = p * t
+            z = z + update
+            fval = (0.5 * resid.add_(Wp * t).pow(2).sum()
+                    + alpha * z.abs().sum())
         else:
             # fixed step size
             update = z_sol - z
             z = torch.where(is_zero, z, z_sol)
             fval = f(z)
+        return z, update, fval
+
+    # In the graphed iteration the zero set is masked unconditionally
+    # (masking is idempotent) and the factor is never reused.
+    graph = None
+    if use_graph:
+        z_in = z.clone(memory_format=torch.contiguous_format)
+
+        def graph_step():
+            diag_factor(z_in)
+            patch_system(is_zero, diag, incremental=False)
+            L, info = factor()
+            _cholesky_solve(rhs_k, L, out=z_buf)
+            return take_step(z_in, z_buf) + (info.ne(0).any(),)
+
+    for k in range(1, maxiter + 1):
+        if use_graph and graph is None and k > 1:
+            graph = torch.cuda.CUDAGraph()
+            try:
+                with torch.cuda.graph(graph):
+                    graph_out = graph_step()
+            except RuntimeError as err:
+                warnings.warn('CUDA graph capture failed (%s). Falling back '
+                              'to eager iterations.' % err)
+                use_graph, graph = False, None
+
+        if use_graph:
+            z_prev = z
+            z_in.copy_(z)
+            if graph is None:
+                # the first iteration doubles as the warm-up run, which must
+                # happen on a side stream before capture
+                stream = torch.cuda.Stream(device=z.device)
+                stream.wait_stream(torch.cuda.current_stream(z.device))
+                with torch.cuda.stream(stream):
+                    z, update, fval, failed = graph_step()
+                torch.cuda.current_stream(z.device).wait_stream(stream)
+            else:
+                graph.replay()
+                z, update, fval, failed = graph_out
+            # graph outputs are overwritten by the next replay
+            z = z.clone()
+        else:
+            diag_factor(z)
+
+            # solve ridge sub-problem
+            if cg:
+                # use conjugate gradient method. A is the precomputed Gram
+                # matrix, so each product is a single [B,D] @ [D,D] matmul.
+                # CG iterates stay exactly zero wherever rhs_k is zero, so
+                # only the output needs masking. We warm-start from the
+                # current z and use a Jacobi preconditioner, which also
+                # absorbs the badly scaled alpha/|z| diagonal.
+                diag_k = diag + tikhonov
+                def Adot(v):
+                    Av = torch.mm(v, A)
+                    Av.masked_fill_(is_zero, 0.)
+                    Av.addcmul_(diag_k, v)
+                    return Av
+                dot = lambda u, v: torch.sum(u*v, 1, keepdim=True)
+                precond = A.diagonal() + diag_k
+                z_sol = conjgrad(rhs_k, Adot, dot,
+                                 x0=z.masked_fill(is_zero, 0.),
+                                 M_inv=lambda v: v / precond, **cg_options)
+            else:
+                # use cholesky factorization
+                is_zero_s, diag_s, rhs_s = (t.to(solve_device)
+                                            for t in (is_zero, diag, rhs_k))
+                # whether the zero set grew only matters for factor reuse;
+                # on the GPU it is not worth a host sync otherwise
+                A_k_diag, zero_set_changed = patch_system(
+                    is_zero_s, diag_s,
+                    incremental=refactor_tol > 0 or solve_device.type == 'cpu')
+
+                # decide whether the cached factor is still close enough
+                refactor = (refactor_tol <= 0 or L is None or zero_set_changed
+                            or k - k_factor >= refactor_every
+                            or bool((A_k_diag - L_diag).abs()
+                                    .gt(refactor_tol * L_diag).any()))
+                if refactor:
+                    L, info = factor()
+                    if torch.all(info == 0):
+                        L_diag = A_k_diag.clone()
+                        k_factor = k
+                    else:
+                        L = None
+                if L is None:
+                    batch_cholesky_solve(rhs_s, A_k, out=z_buf,
+                                         precision=precision)  # [B,D]
+                else:
+                    _cholesky_solve(rhs_s, L, soa, out=z_buf)
+                    if mixed or not refactor:
+                        # one step of iterative refinement w.r.t. the current
+                        # system
+                        resid = rhs_s - torch.bmm(
+                            A_k, z_buf.unsqueeze(2)).squeeze(2)
+                        z_buf.add_(_cholesky_solve(resid, L, soa))
+                z_sol = z_buf.to(z.device, non_blocking=True)
+
+            z, update, fval = take_step(z, z_sol)
 
         if verbose:
             print('iter %3d - fval: %0.4f' % (k, fval))
 
-        # check for convergence
-        if update.abs().sum() <= tol:
-            msg = _status_message['success']
-            break
-
-        # check for NaN
-        if (fval.isnan() | update.isnan().any()):
-            msg = _status_message['nan']
+        # check for convergence or NaN. Both tests are combined on device
+        # into a single host sync. (The Cholesky path syncs once more to check
+        # the factorization status, and again to detect a grown zero set when
+        # the factor may be reused.)
+        update_sum = update.abs().sum()
+        stop = (update_sum <= tol) | update_sum.isnan() | fval.isnan()
+        if use_graph:
+            stop = stop | failed
+        if stop:
+            if use_graph and failed:
+                warnings.warn('Cholesky factorization failed inside the CUDA '
+                              'graph. Falling back to eager iterations.')
+                use_graph, graph = False, None
+                z = z_prev
+                continue
+            if update_sum <= tol:
+                msg = _status_message['success']
+            else:
+                msg = _status_message['nan']
             break
 
     else:
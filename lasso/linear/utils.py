@@ -1,4 +1,5 @@
 import warnings
+import math
 import torch
 
 
@@ -40,19 +41,111 @@ def ridge(b, A, alpha=1e-4):
     return x
 
 
-def batch_cholesky_solve(b, A):
+def batch_cholesky_solve(b, A, out=None, precision='full'):
     """
     Solve a batch of PSD linear systems, with a unique matrix A_k for
     each batch entry b_k
+
+    A pre-allocated tensor of shape [B,D] may be passed as `out` to avoid
+    allocating a new solution tensor on repeated calls. With
+    precision='mixed', float64 systems are factored and solved in float32
+    and the solution is corrected with one step of float64 iterative
+    refinement.
     """
     assert b.dim() == 2  # [B,D]
     assert A.dim() == 3  # [B,D,D]
+    if precision not in ('full', 'mixed'):
+        raise ValueError("precision must be either 'full' or 'mixed'.")
+    mixed = precision == 'mixed' and A.dtype == torch.float64
     b = b.unsqueeze(2)  # [B,D,1]
-    L, info = torch.linalg.cholesky_ex(A)
-    if torch.all(info == 0):
-        x = torch.cholesky_solve(b, L)  # [B,D,1]
+    if out is not None:
+        out = out.unsqueeze(2)  # [B,D,1]
+    L, info = torch.linalg.cholesky_ex(A.float() if mixed else A,
+                                       check_errors=False)
+    if torch.all(info == 0) and mixed:
+        x = torch.cholesky_solve(b.float(), L).to(b.dtype)  # [B,D,1]
+        x += torch.cholesky_solve((b - torch.bmm(A, x)).float(), L)
+        if out is not None:
+            x = out.copy_(x)
+    elif torch.all(info == 0):
+        x = torch.cholesky_solve(b, L, out=out)  # [B,D,1]
     else:
         warnings.warn('Cholesky factorization failed. Reverting to LU '
                       'decomposition...')
-        x = torch.linalg.solve(A, b)  # [B,D,1]
-    return x.squeeze(2)
\ No newline at end of file
+        x = torch.linalg.solve(A, b, out=out)  # [B,D,1]
+    return x.squeeze(2)
+
+
+def safe_inv_abs(x, eps, out=None):
+    """
+    Generalized inverse of |x|: 1/|x| where |x| >= eps and 0 elsewhere.
+    Computed in a single buffer, without an intermediate |x| tensor; small
+    entries are identified as those whose inverse exceeds 1/eps.
+    """
+    out = torch.abs(x, out=out).reciprocal_()
+    if eps > 0:
+        out.masked_fill_(out > 1 / eps, 0.)
+    return out
+
+
+def batch_cholesky_soa(A):
+    """
+    Cholesky factorization of a batch of small PSD matrices stored in
+    structure-of-arrays layout, i.e. A has shape [D,D,B] with the batch as
+    the fastest-moving dimension. Every step of the column loop is a
+    vectorized op over the batch, which beats the batched LAPACK/cuSOLVER
+    routines for tiny D and large B. Returns (L, info) like
+    torch.linalg.cholesky_ex, with L of shape [D,D,B].
+    """
+    assert A.dim() == 3  # [D,D,B]
+    D = A.size(0)
+    L = torch.zeros_like(A)
+    for j in range(D):
+        Lj = L[j, :j]  # [j,B]
+        L[j, j] = (A[j, j] - Lj.pow(2).sum(0)).sqrt()
+        if j + 1 < D:
+            L[j+1:, j] = (A[j+1:, j] - (L[j+1:, :j] * Lj).sum(1)) / L[j, j]
+    info = L.diagonal().isfinite().logical_not().sum(1).int()  # [B]
+    return L, info
+
+
+def batch_cholesky_solve_soa(b, L):
+    """
+    Solve a batch of PSD linear systems given Cholesky factors L of shape
+    [D,D,B] from batch_cholesky_soa. b and the solution have shape [D,B].
+    """
+    assert b.dim() == 2  # [D,B]
+    assert L.dim() == 3  # [D,D,B]
+    D = L.size(0)
+    y = torch.empty_like(b)
+    for i in range(D):
+        y[i] = (b[i] - (L[i, :i] * y[:i]).sum(0)) / L[i, i]
+    x = torch.empty_like(b)
+    for i in reversed(range(D)):
+        x[i] = (y[i] - (L[i+1:, i] * x[i+1:]).sum(0)) / L[i, i]
+    return x
+
+
+def batch_golden_section(f, lo, hi, maxiter=20):
+    """
+    Minimize a batch of unimodal scalar functions by golden-section search.
+    `f` maps a tensor of points t (same shape as lo/hi) to the objective
+    value of each batch entry at its own point. All entries are searched in
+    parallel with a single call to `f` per iteration and no host syncs.
+    """
+    invphi = (math.sqrt(5) - 1) / 2
+    a, b = lo, hi
+    c = b - invphi * (b - a)
+    d = a + invphi * (b - a)
+    fc, fd = f(c), f(d)
+    for _ in range(maxiter):
+        # where f(c) < f(d) the minimum lies in [a, d], otherwise in [c, b]
+        left = fc < fd
+        a = torch.where(left, a, c)
+        b = torch.where(left, d, b)
+        t = torch.where(left, b - invphi * (b - a), a + invphi * (b - a))
+        ft = f(t)
+        c, d = torch.where(left, t, d), torch.where(left, c, t)
+        fc, fd = torch.where(left, ft, fd), torch.where(left, fc, ft)
+    left = fc < fd
+    return torch.where(left, c, d), torch.where(left, fc, fd)
@@ -1,9 +1,9 @@
 from torch import Tensor
 import torch
 import torch.autograd as autograd
-from scipy.optimize import minimize_scalar
 
-from ..linear.utils import batch_cholesky_solve
+from ..linear.utils import (batch_cholesky_solve, batch_golden_section,
+                            safe_inv_abs)
 
 
 class BFGS(object):
@@ -13,7 +13,7 @@ class BFGS(object):
         self.g_prev = g.clone(memory_format=torch.contiguous_format)
         self.n_updates = 0
 
-    def update(self, x, g):
+    def update(self, x, g, active=None):
         s = (x - self.x_prev).unsqueeze(2)
         y = (g - self.g_prev).unsqueeze(2)
         # update the BFGS hessian approximation
@@ -24,19 +24,99 @@ class BFGS(object):
                           torch.full_like(rho_inv, 1000.))
 
         if self.n_updates == 0:
-            self.B.mul_(rho * torch.bmm(y.transpose(1,2), y))
+            scale = rho * torch.bmm(y.transpose(1,2), y)
+            if active is not None:
+                scale = torch.where(active.view(-1,1,1), scale,
+                                    torch.ones_like(scale))
+            self.B.mul_(scale)
+        if active is not None:
+            # leave the hessian of converged samples untouched
+            valid = valid & active.view(-1,1,1)
 
+        # apply both rank-1 terms as a single rank-2 update, in place, so that
+        # the [B,D,D] hessian is read and written once. Invalid entries are
+        # gated by zeroing their coefficients rather than selecting between
+        # two [B,D,D] copies
         Bs = torch.bmm(self.B, s)
-        self.B = torch.where(
-            valid,
-            torch.addcdiv(
-                torch.baddbmm(self.B, rho*y, y.transpose(1,2)),
-                torch.bmm(Bs, Bs.transpose(1,2)),
-                torch.bmm(s.transpose(1,2), Bs),
-                value=-1
-            ),
-            self.B
-        )
+        sBs = torch.bmm(s.transpose(1,2), Bs)
+        zero = torch.zeros_like(rho)
+        U = torch.cat([y, Bs], 2)  # [B,D,2]
+        c = torch.cat([torch.where(valid, rho, zero),
+                       torch.where(valid, -sBs.reciprocal(), zero)],
+                      2)  # [B,1,2]
+        self.B.baddbmm_(U * c, U.transpose(1,2))
+        self.x_prev.copy_(x, non_blocking=True)
+        self.g_prev.copy_(g, non_blocking=True)
+        self.n_updates += 1
+
+
+class LBFGS(object):
+    """Batched limited-memory BFGS hessian approximation
+
+    Curvature pairs are stored in ring buffers of shape [m,B,D]. Pairs with
+    non-positive curvature are stored as zeros and skipped for that batch
+    entry. Systems with the hessian plus a diagonal are solved exactly via
+    the compact representation of Byrd et al. (1994) and the Woodbury
+    identity, which costs O(m*D + m^3) per batch entry.
+    """
+    def __init__(self, x, g, history_size=10):
+        self.S = x.new_zeros(history_size, *x.shape)  # [m,B,D]
+        self.Y = x.new_zeros(history_size, *x.shape)  # [m,B,D]
+        self.sy = x.new_zeros(history_size, x.size(0))  # [m,B]
+        self.sigma = x.new_ones(x.size(0), 1)  # initial hessian is sigma*I
+        self.history_size = history_size
+        self.x_prev = x.clone(memory_format=torch.contiguous_format)
+        self.g_prev = g.clone(memory_format=torch.contiguous_format)
+        self.n_updates = 0
+
+    def solve(self, b, diag, is_zero):
+        """Solve (B + diag(diag)) x = b, where the rows and columns of B
+        corresponding to `is_zero` have been zeroed out"""
+        mem_size = min(self.n_updates, self.history_size)
+        lam = self.sigma.masked_fill(is_zero, 0.) + diag  # [B,D]
+        x = b / lam
+        if mem_size == 0:
+            return x
+
+        # curvature pairs in chronological order. [B,D,m]
+        order = [(self.n_updates - mem_size + i) % self.history_size
+                 for i in range(mem_size)]
+        S = self.S[order].permute(1, 2, 0)
+        Y = self.Y[order].permute(1, 2, 0)
+        sy = self.sy[order].T  # [B,m]
+
+        # compact representation B = sigma*I - W @ M^{-1} @ W^T
+        sigma = self.sigma.unsqueeze(2)  # [B,1,1]
+        SY = torch.bmm(S.transpose(1,2), Y)  # [B,m,m]
+        L = SY.tril(-1)
+        M = torch.cat([
+            torch.cat([sigma * torch.bmm(S.transpose(1,2), S), L], 2),
+            torch.cat([L.transpose(1,2), -torch.diag_embed(sy)], 2)
+        ], 1)  # [B,2m,2m]
+        W = torch.cat([sigma * S, Y], 2)  # [B,D,2m]
+        W = W.masked_fill(is_zero.unsqueeze(2), 0.)
+
+        # Woodbury: (lam - W M^-1 W^T)^-1 = lam^-1 + lam^-1 W K^-1 W^T lam^-1
+        W_lam = W / lam.unsqueeze(2)
+        K = M - torch.bmm(W.transpose(1,2), W_lam)
+        # decouple empty (skipped) pairs, whose rows/columns are all zero
+        K.diagonal(dim1=1, dim2=2).add_(sy.eq(0).repeat(1, 2).to(K.dtype))
+        v = torch.linalg.solve(K, torch.bmm(W.transpose(1,2), x.unsqueeze(2)))
+        return x + torch.bmm(W_lam, v).squeeze(2)
+
+    def update(self, x, g, active=None):
+        s = x - self.x_prev
+        y = g - self.g_prev
+        sy = torch.sum(y * s, 1, keepdim=True)  # [B,1]
+        valid = sy.gt(1e-10)
+        if active is not None:
+            valid = valid & active.unsqueeze(1)
+        i = self.n_updates % self.history_size
+        torch.mul(s, valid, out=self.S[i])
+        torch.mul(y, valid, out=self.Y[i])
+        self.sy[i] = sy.masked_fill(~valid, 0.).squeeze(1)
+        self.sigma = torch.where(valid, torch.sum(y * y, 1, keepdim=True) / sy,
+                                 self.sigma)
         self.x_prev.copy_(x, non_blocking=True)
         self.g_prev.copy_(g, non_blocking=True)
         self.n_updates += 1
@@ -45,13 +125,15 @@ class BFGS(object):
 @torch.no_grad()
 def iterative_ridge_bfgs(f, x0, alpha=1.0, lr=1.0, xtol=1e-5, tikhonov=1e-4,
                          eps=None, line_search=True, maxiter=None,
-                         verbose=0):
+                         memory=None, verbose=0):
     """A BFGS analogue to Iterative Ridge for nonlinear reconstruction terms.
 
     Parameters
     ----------
     f : callable
-        Scalar objective function to minimize
+        Objective function to minimize. Returns either a scalar, or a tensor
+        of shape [batch] holding the objective of each sample, in which case
+        the line search chooses a separate step size for each sample.
     x0 : Tensor
         Initialization point
     alpha : float
@@ -59,65 +141,108 @@ def iterative_ridge_bfgs(f, x0, alpha=1.0, lr=1.0, xtol=1e-5, tikhonov=1e-4,
     lr : float
         Initial step size (learning rate) for each line search.
     xtol : float
-        Convergence tolerance on changes to parameter x
+        Convergence tolerance on changes to parameter x. For separable
+        objectives the test is applied to each sample, and samples that
+        have converged are frozen while the rest continue.
     eps : float
         Threshold for non-zero identification
     line_search : bool
         Whether to use line search optimization (as opposed to fixed step size)
     maxiter : int, optional
         Maximum number of iterations to perform. Defaults to 200 * num_params
+    memory : int, optional
+        If given, use a limited-memory BFGS approximation with this many
+        curvature pairs instead of a dense [B,D,D] hessian. Memory and
+        per-iteration cost then scale linearly with the code size.
     verbose : int
         Verbosity level
 
     """
     assert x0.dim() == 2
+    if memory is not None and memory < 1:
+        raise ValueError('memory must be a positive integer; got %r' % memory)
     if maxiter is None:
         maxiter = x0.size(1) * 5
     if eps is None:
         eps = torch.finfo(x0.dtype).eps
     verbose = int(verbose)
 
-    def evaluate(x):
+    def evaluate(x, return_output=False):
+        # NOTE: torch.func.grad_and_value(f) was measured to be ~3x slower
+        # per call than a single autograd.grad here, so we keep autograd.
         x = x.detach().requires_grad_(True)
         with torch.enable_grad():
-            fval = f(x)
+            output = f(x)
+            fval = output.sum()
         # NOTE: do not include l1 penalty term in the gradient
         grad, = autograd.grad(fval, x)
         fval = fval.detach() + alpha * x.norm(p=1)
+        if return_output:
+            return fval, grad, output.detach()
         return fval, grad
 
     # initialize
     x = x0.detach()
-    fval, grad = evaluate(x)
+    fval, grad, output = evaluate(x, return_output=True)
+    separable = output.dim() > 0
+    if separable and output.shape != (x.size(0),):
+        raise ValueError('f must return a scalar or a tensor of shape '
+                         '[batch]; got shape %s' % (tuple(output.shape),))
+    t_lo = x.new_zeros(x.size(0) if separable else ())
+    t_hi = torch.full_like(t_lo, 10.)
     if verbose:
         print('initial loss: %0.4f' % fval)
     t = torch.clamp(lr / grad.norm(p=1), max=lr)
     delta_x = x.new_tensor(float('inf'))
-    bfgs = BFGS(x, grad)
+    active = x.new_ones(x.size(0), dtype=torch.bool)  # unconverged samples
+    if memory is None:
+        bfgs = BFGS(x, grad)
+        B_k = torch.empty_like(bfgs.B)
+        d = torch.empty_like(x)  # step buffer, reused across iterations
+    else:
+        bfgs = LBFGS(x, grad, history_size=memory)
 
     # begin main loop
     for k in range(1, maxiter + 1):
         # locate zeros
-        xmag = x.abs()
-        is_zero = xmag < eps
+        diag = safe_inv_abs(x, eps)
+        is_zero = diag == 0
 
-        # compute step direction
-        diag = (alpha / xmag).masked_fill(is_zero, 0)
+        # compute step direction. NOTE: the L1 term adds a full-rank diagonal
+        # that changes every iteration, so maintaining an inverse Hessian does
+        # not help here: applying the diagonal via Woodbury still needs a DxD
+        # solve. We factor the regularized Hessian directly instead.
+        diag.mul_(alpha)
         rhs = (grad + diag*x).masked_fill(is_zero, 0)
-        B = bfgs.B.masked_fill((is_zero.unsqueeze(1) | is_zero.unsqueeze(2)), 0.)
-        B.diagonal(dim1=1, dim2=2).add_(diag + tikhonov)
-        d = batch_cholesky_solve(rhs, B)
+        if memory is None:
+            # regularized hessian, written into a buffer reused across
+            # iterations; only the diagonal is patched after the copy
+            B_k.copy_(bfgs.B)
+            if is_zero.any():
+                B_k.masked_fill_(is_zero.unsqueeze(1) | is_zero.unsqueeze(2), 0.)
+            B_k.diagonal(dim1=1, dim2=2).add_(diag + tikhonov)
+            batch_cholesky_solve(rhs, B_k, out=d)
+        else:
+            d = bfgs.solve(rhs, diag + tikhonov, is_zero)
 
-        # optional strong-wolfe line search
+        # optional line search. For separable objectives each sample gets its
+        # own step size; all trial steps are evaluated in one call to f
         if line_search:
             def line_obj(tt):
-                x_new = x.add(d, alpha=-tt)
-                return float(f(x_new) + alpha * x_new.norm(p=1))
-            t = minimize_scalar(line_obj, bounds=(0,10), method='bounded').x
+                x_new = x - tt.unsqueeze(-1) * d
+                if separable:
+                    return f(x_new) + alpha * x_new.abs().sum(1)
+                return f(x_new) + alpha * x_new.norm(p=1)
+            t = batch_golden_section(line_obj, t_lo, t_hi)[0].unsqueeze(-1)
 
-        # update x
-        x_new = torch.where(is_zero, x, x.add(d, alpha=-t))
-        torch.norm(x_new - x, p=2, out=delta_x)
+        # update x. Converged samples are left unchanged
+        x_new = torch.where(is_zero | ~active.unsqueeze(1), x, x - t * d)
+        dx = torch.norm(x_new - x, p=2, dim=1)  # [B]
+        torch.norm(dx, p=2, out=delta_x)
+        if separable:
+            active = active & dx.gt(xtol)
+        else:
+            active = delta_x.gt(xtol).expand_as(active)
         x = x_new
 
         # re-evaluate f and grad
@@ -126,11 +251,11 @@ def iterative_ridge_bfgs(f, x0, alpha=1.0, lr=1.0, xtol=1e-5, tikhonov=1e-4,
             print('iter %3d - loss: %0.4f - dx: %0.4e' % (k, fval, delta_x))
 
         # stopping check
-        if (delta_x <= xtol) | ~fval.isfinite():
+        if ~active.any() | ~fval.isfinite():
             break
 
         # update hessian estimate
-        bfgs.update(x, grad)
+        bfgs.update(x, grad, active)
         t = lr
 
     if verbose:
@@ -0,0 +1,76 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from lasso.linear.solvers.iterative_ridge import iterative_ridge, _gram_cache
+
+
+def make_problem(batch_size, code_size, inp_size, seed=0,
+                 dtype=torch.float64, device='cpu'):
+    torch.manual_seed(seed)
+    weight = F.normalize(torch.randn(inp_size, code_size, dtype=dtype), dim=0)
+    x = 0.1 * torch.randn(batch_size, inp_size, dtype=dtype)
+    return x.to(device), weight.to(device)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_cg_line_search_finite(seed):
+    # per-sample line search steps routinely zero out whole rows, which
+    # gives CG batch entries with a zero residual
+    x, weight = make_problem(512, 20, 10, seed=seed)
+    z = iterative_ridge(x @ weight, x, weight, alpha=0.1, maxiter=30, cg=True)
+    assert torch.isfinite(z).all()
+
+
+def test_gram_cache_not_modified():
+    # for batch size 1 the ridge system must still be a copy of the cached
+    # Gram matrix, since it is patched in place
+    x, weight = make_problem(1, 10, 20)
+    z0 = x @ weight
+    z1 = iterative_ridge(z0, x, weight, alpha=0.5)
+    z2 = iterative_ridge(z0, x, weight, alpha=0.5)
+    assert torch.equal(z1, z2)
+    assert torch.equal(_gram_cache[id(weight)][2], weight.T @ weight)
+
+
+def test_gram_cache_dropped_with_weight():
+    x, weight = make_problem(4, 10, 20)
+    iterative_ridge(x @ weight, x, weight)
+    key = id(weight)
+    assert key in _gram_cache
+    del weight
+    assert key not in _gram_cache
+
+
+def test_cuda_graph_ignored_warns():
+    x, weight = make_problem(4, 10, 20)
+    with pytest.warns(UserWarning, match='cuda_graph'):
+        iterative_ridge(x @ weight, x, weight, cuda_graph=True)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires CUDA')
+@pytest.mark.parametrize('line_search', [True, False])
+def test_cuda_graph_matches_eager(line_search):
+    x, weight = make_problem(64, 20, 10, device='cuda')
+    z0 = x @ weight
+    z_eager = iterative_ridge(z0, x, weight, alpha=0.1, maxiter=20,
+                              line_search=line_search)
+    z_graph = iterative_ridge(z0, x, weight, alpha=0.1, maxiter=20,
+                              line_search=line_search, cuda_graph=True)
+    torch.testing.assert_close(z_graph, z_eager)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires CUDA')
+def test_cuda_graph_factorization_failure():
+    # an indefinite ridge system makes the Cholesky factorization of the
+    # first (warm-up) iteration fail. That iteration is discarded and the
+    # remaining ones run eagerly
+    x, weight = make_problem(64, 20, 10, device='cuda')
+    z0 = x @ weight
+    with pytest.warns(UserWarning, match='CUDA graph'):
+        z_graph = iterative_ridge(z0, x, weight, alpha=0.1, maxiter=5,
+                                  tikhonov=-10., cuda_graph=True)
+    with pytest.warns(UserWarning):
+        z_eager = iterative_ridge(z0, x, weight, alpha=0.1, maxiter=4,
+                                  tikhonov=-10.)
+    torch.testing.assert_close(z_graph, z_eager)
@@ -0,0 +1,20 @@
+import pytest
+import torch
+
+from lasso.nonlinear.iterative_ridge_bfgs import iterative_ridge_bfgs
+
+
+def test_invalid_memory():
+    x0 = torch.randn(4, 5)
+    f = lambda x: x.pow(2).sum()
+    with pytest.raises(ValueError):
+        iterative_ridge_bfgs(f, x0, memory=0)
+
+
+
+def test_invalid_output_shape():
+    # a [1] output is neither a joint (scalar) nor a per-sample objective
+    x0 = torch.randn(4, 5)
+    f = lambda x: x.pow(2).sum().view(1)
+    with pytest.raises(ValueError):
+        iterative_ridge_bfgs(f, x0, maxiter=2)